@@ -14,19 +14,47 @@ Heuristics:
 - For Free2Move: extracts pickup and return dates from the trip details table
 - For both: extracts net cost from invoice
 
+Eurowings text is extracted with poppler's pdftotext when it is on PATH, otherwise with
+pypdfium2 when installed, and with pdfminer.six as the fallback. Free2Move receipts always
+use pdfminer.six: their parsers rely on it putting each table cell on a line of its own.
+
 Usage:
   python parse.py /path/to/file.pdf
   python parse.py /path/to/*.pdf --dry-run
 """
 
+import io
+import os
+import glob
 import re
 import sys
+import shutil
 import argparse
+import subprocess
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from typing import Optional, Tuple, List
+from typing import Callable, Dict, Iterator, Optional, Set, Tuple, List
+
+from pdfminer.converter import TextConverter
+from pdfminer.layout import LAParams
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+# Lines are still grouped, but the expensive hierarchical text box ordering is skipped
+PDFMINER_LAPARAMS = LAParams(boxes_flow=None, detect_vertical=False, all_texts=False)
 
-from pdfminer.high_level import extract_text
+# Number of result messages written to stdout at once
+OUTPUT_BATCH_SIZE = 32
+
+# poppler's pdftotext is a native extractor and by far the fastest option
+PDFTOTEXT = shutil.which("pdftotext")
 
 # -------- helpers --------
 
@@ -48,18 +76,50 @@ NAME_HINTS = [
 
 KNOWN_PASSENGERS = ["Andre Ziemke", "Thomas Stoeckel"]
 
+# "First Last", "Last First" and "First/Last" spellings, mapped back to the canonical name
+PASSENGER_VARIANTS = {
+    variant: name
+    for name in KNOWN_PASSENGERS
+    for variant in (name.lower(), " ".join(name.lower().split()[::-1]), name.lower().replace(" ", "/"))
+}
+PASSENGER_RE = re.compile("|".join(re.escape(v) for v in sorted(PASSENGER_VARIANTS, key=len, reverse=True)))
+
 HIN_HINTS = [r"\bHinflug\b", r"\bOutbound\b", r"\bDeparture\b"]
 RUECK_HINTS = [r"\bRückflug\b", r"\bRueckflug\b", r"\bReturn\b"]
 
 FLIGHT_ROW_HINT = re.compile(r"\b(EW\s?\d{2,4})\b", re.IGNORECASE)
 
+# Eurowings: 'Flug: 06.10.2025 | Flugnummer: EW 9083' (German & English)
+FLIGHT_RE = re.compile(
+    r"(?:Flight|Flug):\s*(\d{1,2}\.\d{1,2}\.\d{4}).*?(?:Flight Number|Flugnummer)[:\s]*?(EW\s*\d{3,4})",
+    re.IGNORECASE,
+)
+VAT_RE = re.compile(r"19\s?%[\s]*(?:VAT|MwSt)", re.IGNORECASE)
+EURO_RE = re.compile(r"(\d{1,3}(?:[.,]\d{2}))\s*€")
+
+# Free2Move: amounts like '146,71' on lines of their own
+F2M_EURO_RE = re.compile(r"^(\d{1,4}),(\d{2})")
+
+BAD_CHARS = re.compile(r"[\\/:*?\"<>|]")
+WS = re.compile(r"\s+")
+
 
 def sanitize_filename_component(s: str) -> str:
-    s = re.sub(r"[\\/:*?\"<>|]", " ", s)
-    s = re.sub(r"\s+", " ", s).strip()
+    s = BAD_CHARS.sub(" ", s)
+    s = WS.sub(" ", s).strip()
     return s
 
 
+def flight_row_date(line: str) -> Optional[datetime]:
+    m = FLIGHT_RE.search(line)
+    if not m:
+        return None
+    try:
+        return datetime.strptime(m.group(1), "%d.%m.%Y")
+    except ValueError:
+        return None
+
+
 def parse_dates_from_text(lines: List[str]) -> Tuple[Optional[datetime], Optional[datetime]]:
     """
     Parses flight dates and numbers from lines like:
@@ -68,46 +128,36 @@ def parse_dates_from_text(lines: List[str]) -> Tuple[Optional[datetime], Optiona
 
     Returns (departure_date, return_date)
     """
-    # Combined pattern for both German & English
-    flight_pattern = re.compile(
-        r"(?:Flight|Flug):\s*(\d{1,2}\.\d{1,2}\.\d{4}).*?(?:Flight Number|Flugnummer)[:\s]*?(EW\s*\d{3,4})",
-        re.IGNORECASE,
-    )
-
-    flights = []
+    dates: List[datetime] = []
+    in_order = True
     for line in lines:
-        m = flight_pattern.search(line)
-        if m:
-            date_str, flight_no = m.groups()
-            try:
-                date = datetime.strptime(date_str, "%d.%m.%Y")
-                flight_no = flight_no.replace(" ", "")
-                flights.append((date, flight_no))
-            except ValueError:
-                continue
-
-    if not flights:
+        date = flight_row_date(line)
+        if date:
+            in_order = in_order and (not dates or date >= dates[-1])
+            dates.append(date)
+            # Outbound and return found; if the rows are out of order, read them all and sort below
+            if in_order and date != dates[0]:
+                break
+
+    if not dates:
         return None, None
 
     # Sort by date just in case the order in the PDF is reversed
-    flights.sort(key=lambda x: x[0])
+    dates.sort()
 
-    dep = flights[0][0]
-    ret = flights[1][0] if len(flights) > 1 else None
+    dep = dates[0]
+    ret = dates[1] if len(dates) > 1 else None
 
     return dep, ret
 
 
 def parse_name_from_text(lines: list[str]) -> str | None:
     """Return the passenger name by checking against a predefined list."""
-    text = " ".join(lines).lower()
-    for name in KNOWN_PASSENGERS:
-        # match both "First Last" and "LAST/FIRST" variants
-        normalized = name.lower()
-        reversed_variant = " ".join(normalized.split()[::-1])
-        slash_variant = normalized.replace(" ", "/")
-        if normalized in text or reversed_variant in text or slash_variant in text:
-            return name
+    for line in lines:
+        # Match on the lowercased line, so the hit is always a key of PASSENGER_VARIANTS
+        m = PASSENGER_RE.search(line.lower())
+        if m:
+            return PASSENGER_VARIANTS[m.group()]
     return None
 
 
@@ -119,12 +169,9 @@ def parse_net_cost_from_text(lines: List[str]) -> Optional[float]:
     or
       (3)* 19 % MwSt (17,95 €) 94,47 € 112,42 €
     """
-    vat_pattern = re.compile(r"19\s?%[\s]*(?:VAT|MwSt)", re.IGNORECASE)
-    euro_pattern = re.compile(r"(\d{1,3}(?:[.,]\d{2}))\s*€")
-
     for line in lines:
-        if vat_pattern.search(line):
-            euro_values = euro_pattern.findall(line)
+        if VAT_RE.search(line):
+            euro_values = EURO_RE.findall(line)
             # Expecting 2 amounts: (VAT, net; gross is in a separate cell, because the layout is a table)
             if len(euro_values) >= 2:
                 net_str = euro_values[1].replace(",", ".")
@@ -144,14 +191,126 @@ def format_date(d: datetime, label: str = "") -> str:
     # return d.strftime("%Y-%m-%d")
 
 
-def extract_lines(pdf_path: Path) -> List[str]:
-    text = extract_text(str(pdf_path)) or ""
-    # Normalize some whitespace and split into lines
-    text = re.sub(r"\r", "\n", text)
-    lines = [ln.strip() for ln in text.split("\n") if ln.strip()]
+def extract_text_pdftotext(exe: str, pdf_path: Path) -> str:
+    result = subprocess.run(
+        [exe, "-enc", "UTF-8", str(pdf_path), "-"],
+        capture_output=True,
+        check=True,
+        timeout=30,
+    )
+    return result.stdout.decode("utf-8")
+
+
+def iter_pages_pdfium(pdf) -> Iterator[str]:
+    try:
+        for page in pdf:
+            yield page.get_textpage().get_text_range()
+    finally:
+        pdf.close()
+
+
+def iter_pages_pdfminer(pdf_path: Path) -> Iterator[str]:
+    # One resource manager per file: its font cache is keyed by object ids, which are only
+    # unique within a document (CMaps are cached process-wide by pdfminer anyway)
+    rsrcmgr = PDFResourceManager(caching=True)
+    output = io.StringIO()
+    device = TextConverter(rsrcmgr, output, laparams=PDFMINER_LAPARAMS)
+    interpreter = PDFPageInterpreter(rsrcmgr, device)
+    try:
+        with open(pdf_path, "rb") as fp:
+            for page in PDFPage.get_pages(fp, caching=True):
+                interpreter.process_page(page)
+                yield output.getvalue()
+                output.seek(0)
+                output.truncate()
+    finally:
+        device.close()
+
+
+def iter_page_texts(pdf_path: Path, pdfminer_only: bool = False) -> Iterator[str]:
+    if not pdfminer_only and PDFTOTEXT:
+        try:
+            text = extract_text_pdftotext(PDFTOTEXT, pdf_path)
+        except (subprocess.SubprocessError, OSError):
+            # pdftotext failed or timed out; let the next extractor try
+            text = None
+        if text is not None:
+            # pdftotext converts the whole file at once, pages are separated by form feeds
+            yield from text.split("\f")
+            return
+    if not pdfminer_only and pdfium is not None:
+        try:
+            pdf = pdfium.PdfDocument(str(pdf_path))
+        except pdfium.PdfiumError:
+            # PDFium rejected the file; pdfminer may still read it
+            pdf = None
+        if pdf is not None:
+            yield from iter_pages_pdfium(pdf)
+            return
+    yield from iter_pages_pdfminer(pdf_path)
+
+
+def extract_lines(
+    pdf_path: Path, done: Optional[Callable[[List[str]], bool]] = None, pdfminer_only: bool = False
+) -> List[str]:
+    """
+    Extract the non-empty, stripped text lines of the PDF page by page.
+    If `done` is given, it is called with the lines of each new page; stop reading further pages as
+    soon as it returns True.
+    With `pdfminer_only`, skip the faster extractors, whose line breaks differ from pdfminer's.
+    """
+    lines: List[str] = []
+    for text in iter_page_texts(pdf_path, pdfminer_only):
+        # Normalize some whitespace and split into lines
+        text = text.replace("\r", "\n")
+        page_lines = [s for ln in text.split("\n") if (s := ln.strip())]
+        lines.extend(page_lines)
+        if done and done(page_lines):
+            break
     return lines
 
 
+class EurowingsProbe:
+    """
+    `done` callback for extract_lines: True once the pages read so far contain the passenger,
+    the net cost and the outbound and return flight. Each page is checked once; fields
+    already found are remembered, so the check stays linear in the number of pages.
+    """
+
+    def __init__(self) -> None:
+        self.passenger = False
+        self.net_cost = False
+        self.flights = False
+        self.flights_in_order = True
+        self.flight_dates: List[datetime] = []
+
+    @property
+    def complete(self) -> bool:
+        return self.passenger and self.net_cost and self.flights
+
+    def __call__(self, page_lines: List[str]) -> bool:
+        if not self.passenger:
+            self.passenger = parse_name_from_text(page_lines) is not None
+        if not self.net_cost:
+            self.net_cost = parse_net_cost_from_text(page_lines) is not None
+        # Same stopping rule as parse_dates_from_text: a later second date, all rows in order
+        if not self.flights and self.flights_in_order:
+            dates = self.flight_dates
+            for line in page_lines:
+                date = flight_row_date(line)
+                if not date:
+                    continue
+                if dates and date < dates[-1]:
+                    # Rows out of order: parse_dates_from_text needs all of them to sort
+                    self.flights_in_order = False
+                    break
+                dates.append(date)
+                if date != dates[0]:
+                    self.flights = True
+                    break
+        return self.complete
+
+
 def parse_free2move_dates(lines: List[str]) -> Tuple[Optional[datetime], Optional[datetime]]:
     """
     Parse pickup and return dates from Free2Move PDF.
@@ -166,19 +325,12 @@ def parse_free2move_dates(lines: List[str]) -> Tuple[Optional[datetime], Optiona
       24.09.25
       17:03
     """
-    # Pattern for short date format DD.MM.YY
-    date_pattern = re.compile(r"^(\d{2})\.(\d{2})\.(\d{2})$")
-    
     dates = []
     for line in lines:
-        m = date_pattern.match(line)
-        if m:
-            day, month, year = m.groups()
-            # Convert 2-digit year to 4-digit (20YY)
-            full_year = f"20{year}"
+        # Cheap shape check first, so strptime (and its exception) only sees DD.MM.YY candidates
+        if len(line) == 8 and line[2] == "." and line[5] == ".":
             try:
-                date = datetime.strptime(f"{day}.{month}.{full_year}", "%d.%m.%Y")
-                dates.append(date)
+                dates.append(datetime.strptime(line, "%d.%m.%y"))
             except ValueError:
                 continue
     
@@ -214,11 +366,9 @@ def parse_free2move_net_cost(lines: List[str]) -> Optional[float]:
         if line == "Netto":
             # Look through the next several lines for Euro amounts
             # Match lines that start with a number pattern (may have additional values after)
-            euro_pattern = re.compile(r"^(\d{1,4}),(\d{2})")
-            
             # Check the next 10 lines for the net amount
             for j in range(i + 1, min(i + 11, len(lines))):
-                m = euro_pattern.match(lines[j])
+                m = F2M_EURO_RE.match(lines[j])
                 if m:
                     # First match after the header row should be the net cost
                     amount_str = f"{m.group(1)}.{m.group(2)}"
@@ -271,51 +421,108 @@ def build_free2move_filename(
     return base + ".pdf"
 
 
-def process_file(pdf_path: Path, dry_run: bool = False) -> Tuple[bool, str]:
+def parse_eurowings_filename(lines: List[str]) -> Optional[str]:
+    passenger = parse_name_from_text(lines)
+    dep, ret = parse_dates_from_text(lines)
+    net_cost = parse_net_cost_from_text(lines)
+    return build_filename(passenger, dep, ret, net_cost)
+
+
+def parse_file(pdf_path: Path) -> Tuple[Optional[str], str]:
+    """Return (new_name, "") for a recognized invoice, or (None, error_message)."""
     try:
-        lines = extract_lines(pdf_path)
-        
         # Check if this is a Free2Move invoice by filename prefix
         is_free2move = pdf_path.name.startswith("Free2move")
-        
+
         if is_free2move:
-            # Parse Free2Move invoice
+            # Parse Free2Move invoice; pdfium merges the table rows the parsers read cell by cell
+            lines = extract_lines(pdf_path, pdfminer_only=True)
             dep, ret = parse_free2move_dates(lines)
             net_cost = parse_free2move_net_cost(lines)
             new_name = build_free2move_filename(dep, ret, net_cost)
             if not new_name:
                 return (
-                    False,
+                    None,
                     f"[{pdf_path.name}] Konnte erforderliche Daten nicht sicher ermitteln (Abholung-Datum fehlt).",
                 )
         else:
-            # Parse Eurowings invoice
-            passenger = parse_name_from_text(lines)
-            dep, ret = parse_dates_from_text(lines)
-            net_cost = parse_net_cost_from_text(lines)
-            new_name = build_filename(passenger, dep, ret, net_cost)
+            # Parse Eurowings invoice, reading only as many pages as needed
+            probe = EurowingsProbe()
+            lines = extract_lines(pdf_path, done=probe)
+            if not probe.complete and (PDFTOTEXT or pdfium is not None):
+                # A field is missing; the faster extractors may have broken its line differently
+                # than pdfminer, whose output the parsers are written for, so let pdfminer decide
+                lines = extract_lines(pdf_path, done=EurowingsProbe(), pdfminer_only=True)
+            new_name = parse_eurowings_filename(lines)
             if not new_name:
                 return (
-                    False,
+                    None,
                     f"[{pdf_path.name}] Konnte erforderliche Daten nicht sicher ermitteln (Name oder Abflugdatum fehlt).",
                 )
 
+        return new_name, ""
+    except (FileNotFoundError, IsADirectoryError):
+        # pypdfium2 reports a directory as missing and puts only the path in the message
+        problem = "Pfad ist ein Verzeichnis" if pdf_path.is_dir() else "Datei nicht gefunden"
+        return None, f"[{pdf_path.name}] Fehler: {problem}."
+    except Exception as e:
+        return None, f"[{pdf_path.name}] Fehler: {e}"
+
+
+def rename_file(pdf_path: Path, new_name: str, dir_names: Dict[Path, Set[str]]) -> Tuple[bool, str]:
+    """
+    Rename without overwriting, appending " (n)" until the name is free.
+    `dir_names` caches the file names per directory and is updated after every rename, so
+    files renamed one after another from the same process never end up with the same name.
+    """
+    try:
+        directory = pdf_path.absolute().parent
+        if directory not in dir_names:
+            # One directory listing instead of a stat() per candidate name
+            dir_names[directory] = {entry.name for entry in os.scandir(directory)}
         new_path = pdf_path.with_name(new_name)
-        if dry_run:
-            return True, f"DRY-RUN: {pdf_path.name}  →  {new_name}"
-        else:
-            # Avoid overwriting
+        while True:
+            existing = dir_names[directory]
             counter = 1
             final_path = new_path
-            while final_path.exists():
-                stem = final_path.stem
-                suffix = final_path.suffix
-                final_path = pdf_path.with_name(f"{stem} ({counter}){suffix}")
+            while final_path.name in existing:
+                final_path = pdf_path.with_name(f"{new_path.stem} ({counter}){new_path.suffix}")
                 counter += 1
-            pdf_path.rename(final_path)
-            return True, f"Umbenannt: {pdf_path.name}  →  {final_path.name}"
-    except Exception as e:
+            # The listing may be stale if something else wrote to the directory since
+            if not final_path.exists():
+                break
+            dir_names[directory] = {entry.name for entry in os.scandir(directory)}
+            # Also covers case-insensitive file systems, where the listing spells the name differently
+            dir_names[directory].add(final_path.name)
+        os.rename(pdf_path, final_path)
+    except OSError as e:
         return False, f"[{pdf_path.name}] Fehler: {e}"
+    existing.discard(pdf_path.name)
+    existing.add(final_path.name)
+    return True, f"Umbenannt: {pdf_path.name}  →  {final_path.name}"
+
+
+def parse_files(files: List[Path]) -> Iterator[Tuple[Optional[str], str]]:
+    if len(files) == 1:
+        yield parse_file(files[0])
+        return
+    # Parsing is CPU-bound and PDFium is not thread-safe, so use processes, dry run or not
+    done = 0
+    with ProcessPoolExecutor(max_workers=min(len(files), os.cpu_count() or 1)) as ex:
+        try:
+            for result in ex.map(parse_file, files):
+                yield result
+                done += 1
+        except BrokenProcessPool:
+            # A worker died, e.g. from a crash inside PDFium; report the rest instead of aborting
+            for f in files[done:]:
+                yield None, f"[{f.name}] Fehler: Verarbeitung abgebrochen, ein Worker-Prozess ist abgestürzt."
+
+
+def write_lines(msgs: List[str]) -> None:
+    if msgs:
+        sys.stdout.write("\n".join(msgs) + "\n")
+        sys.stdout.flush()
 
 
 def main():
@@ -326,21 +533,35 @@ def main():
 
     files: List[Path] = []
     for p in args.paths:
-        # Expand globs ourselves for portability
-        matches = list(Path().glob(p)) if any(ch in p for ch in "*?[]") else [Path(p)]
-        for m in matches:
-            if m.is_file() and m.suffix.lower() == ".pdf":
-                files.append(m)
+        # Expand globs ourselves for portability; plain paths are only checked once parse_file opens them
+        matches = glob.iglob(p, recursive=True) if any(ch in p for ch in "*?[]") else [p]
+        files.extend(Path(m) for m in matches if m.lower().endswith(".pdf"))
 
     if not files:
         print("Keine passenden PDF-Dateien gefunden.")
         sys.exit(2)
 
     ok_all = True
-    for f in files:
-        ok, msg = process_file(f, dry_run=args.dry_run)
-        print(msg)
-        ok_all = ok_all and ok
+    msgs: List[str] = []
+    dir_names: Dict[Path, Set[str]] = {}
+    try:
+        # Only the parsing runs in parallel; renaming happens here, one file at a time
+        for i, (f, (new_name, error)) in enumerate(zip(files, parse_files(files)), 1):
+            if not new_name:
+                ok, msg = False, error
+            elif args.dry_run:
+                ok, msg = True, f"DRY-RUN: {f.name}  →  {new_name}"
+            else:
+                ok, msg = rename_file(f, new_name, dir_names)
+            msgs.append(msg)
+            ok_all = ok_all and ok
+            # Write results in batches, but keep showing progress on large runs
+            if i % OUTPUT_BATCH_SIZE == 0:
+                write_lines(msgs)
+                msgs.clear()
+    finally:
+        # Also write out what is pending when the run is interrupted or the pool breaks
+        write_lines(msgs)
 
     sys.exit(0 if ok_all else 1)
 